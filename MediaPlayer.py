@@ -1,22 +1,44 @@
 import abc
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import getpass
+import json
+import os
+import sys
+import threading
+import unicodedata
+import plexapi
 import plexapi.playlist
 import plexapi.audio
+import plexapi.library
 from plexapi.exceptions import BadRequest, NotFound
 from plexapi.myplex import MyPlexAccount
-import time
-from typing import List, Optional, Union
+from plexapi.server import PlexServer
+from rapidfuzz import fuzz, process
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from urllib.parse import urlencode
+try:
+	import win32com.client
+except ImportError:  # the COM interface is only available on Windows
+	win32com = None
 
-from sync_items import AudioTag, Playlist
+from sync_items import AudioTag, Playlist, normalize
 
 
 class MediaPlayer(abc.ABC):
+	_name_lower = None
 	album_empty_alias = ''
 	dry_run = False
 	reverse = False
 	rating_maximum = 5
 
+	def __init__(self):
+		self._album_empty_alias = sys.intern(self.album_empty_alias)
+		self._album_empty_alias_length = len(self._album_empty_alias)
+
 	@staticmethod
 	@abc.abstractmethod
 	def name():
@@ -39,9 +61,7 @@ class MediaPlayer(abc.ABC):
 		return NotImplementedError
 
 	def album_empty(self, album):
-		if not isinstance(album, str):
-			return False
-		return album == self.album_empty_alias
+		return type(album) is str and len(album) == self._album_empty_alias_length and album == self._album_empty_alias
 
 	def connect(self, *args, **kwargs):
 		return NotImplemented
@@ -60,8 +80,10 @@ class MediaPlayer(abc.ABC):
 		return normed_rating * self.rating_maximum
 
 	def get_normed_rating(self, rating: Optional[float]):
-		if (rating or 0) <= 0:
-			rating = 0
+		if not rating or rating <= 0:
+			return 0.0
+		# Deliberately a division: multiplying with 1 / rating_maximum is inexact (e.g. 3 * 0.1 != 30 * 0.01), which would let
+		# equal ratings of two players compare as conflicting
 		return rating / self.rating_maximum
 
 	@abc.abstractmethod
@@ -106,6 +128,37 @@ class MediaPlayer(abc.ABC):
 		"""
 		pass
 
+	def search_tracks_many(self, titles: Iterable[str]) -> Dict[str, List[object]]:
+		"""Searches the music library for tracks matching any of the given titles.
+
+		:param titles: The track titles to search for. Duplicates are searched only once.
+
+		:return: a dictionary mapping each title to its list of matching tracks
+		"""
+		return {title: self.search_tracks(key="title", value=title) for title in dict.fromkeys(titles)}
+
+	def track_id(self, track):
+		"""
+		:param track: a track as returned by search_tracks
+		:return: the identifier of the track in this player, as accepted by find_tracks
+		"""
+		return track.ID
+
+	def find_tracks(self, ids: Iterable[object]) -> Dict[object, object]:
+		"""Looks up tracks by the identifiers returned by track_id.
+
+		:return: a dictionary mapping each identifier to its track. Tracks that do not exist anymore are left out.
+		"""
+		return {}
+
+	def search_similar_tracks(self, track: AudioTag) -> List[object]:
+		"""Looks up the tracks most similar to @track, for tracks whose title search found nothing.
+		Matches with these tracks are less certain than with those of the title search, so they are not cached.
+
+		:return: a list of similar tracks, or an empty list if none is similar enough
+		"""
+		return []
+
 	@abc.abstractmethod
 	def update_playlist(self, playlist, track, present: bool):
 		"""Updates the playlist, unless in dry run
@@ -116,21 +169,36 @@ class MediaPlayer(abc.ABC):
 		:param present:
 		"""
 
+	def add_to_playlist(self, playlist, tracks: List[object]):
+		"""Adds all tracks to the playlist, unless in dry run"""
+		for track in tracks:
+			self.update_playlist(playlist, track, True)
+
 	@abc.abstractmethod
 	def update_rating(self, track, rating):
 		"""Updates the rating of the track, unless in dry run"""
 
+	def update_ratings_bulk(self, updates: List[Tuple[object, float]]):
+		"""Updates the ratings of several tracks, unless in dry run
+		:param updates:
+			Pairs of a track native to this player and its new normed rating
+		"""
+		for track, rating in updates:
+			self.update_rating(track, rating)
+
 	def __hash__(self):
-		return hash(self.name().lower())
+		return hash(self._name_lower)
 
 	def __eq__(self, other):
-		if not isinstance(other, type(self)):
+		if not isinstance(other, MediaPlayer):
 			return NotImplemented
-		return other.name().lower() == self.name().lower()
+		return type(other) is type(self)
 
 
 class MediaMonkey(MediaPlayer):
+	_name_lower = 'mediamonkey'
 	rating_maximum = 100
+	maximum_ids_per_query = 500
 
 	def __init__(self):
 		super(MediaMonkey, self).__init__()
@@ -148,9 +216,12 @@ class MediaMonkey(MediaPlayer):
 
 	def connect(self, *args):
 		self.logger.info('Connecting to local player {}'.format(self.name()))
-		import win32com.client
+		if win32com is None:
+			self.logger.error('The pywin32 package is required to connect to {}. Exiting...'.format(self.name()))
+			exit(1)
 		try:
-			self.sdb = win32com.client.Dispatch("SongsDB.SDBApplication")
+			# Early binding through the makepy generated wrappers avoids resolving every property access at runtime
+			self.sdb = win32com.client.gencache.EnsureDispatch("SongsDB.SDBApplication")
 			self.sdb.ShutdownAfterDisconnect = False
 		except Exception:
 			self.logger.error('No scripting interface to MediaMonkey can be found. Exiting...')
@@ -167,19 +238,22 @@ class MediaMonkey(MediaPlayer):
 		:rtype: list<Playlist>
 		"""
 		playlists = []
-		for i in range(len(parent_playlist.ChildPlaylists)):
-			_playlist = parent_playlist.ChildPlaylists[i]
-			playlist = Playlist(_playlist.Title, parent_name=parent_playlist.Title)
+		# Every access to ChildPlaylists or Tracks creates a new list on the COM server, so fetch them only once
+		child_playlists = parent_playlist.ChildPlaylists
+		parent_title = parent_playlist.Title
+		for i in range(child_playlists.Count):
+			_playlist = child_playlists.Item(i)
+			playlist = Playlist(_playlist.Title, parent_name=parent_title)
 			playlists.append(playlist)
 			playlist.is_auto_playlist = _playlist.isAutoplaylist
 			if playlist.is_auto_playlist:
 				self.logger.debug('Skipping to read tracks for auto playlist {}'.format(playlist.name))
 				continue
 
-			for j in range(_playlist.Tracks.Count):
-				playlist.tracks.append(self.read_track_metadata(_playlist.Tracks[j]))
+			tracks = _playlist.Tracks
+			playlist.tracks.extend(self.read_track_metadata(tracks.Item(j)) for j in range(tracks.Count))
 
-			if len(_playlist.ChildPlaylists):
+			if _playlist.ChildPlaylists.Count:
 				playlists.extend(self.read_child_playlists(_playlist))
 
 		return playlists
@@ -196,6 +270,7 @@ class MediaMonkey(MediaPlayer):
 		tag.rating = self.get_normed_rating(track.Rating)
 		tag.ID = track.ID
 		tag.track = track.TrackOrder
+		tag._sdb_item = track
 		return tag
 
 	def search_tracks(self, key: str, value: Union[bool, str]) -> List[AudioTag]:
@@ -213,44 +288,105 @@ class MediaMonkey(MediaPlayer):
 			query = value
 		else:
 			raise KeyError(f"Invalid search mode {key}.")
-		self.logger.debug(f'Executing query [{query}] against {self.name()}')
+		self.logger.debug('Executing query [%s] against %s', query, self.name())
+
+		tags = self._bulk_read_tags(query)
+		self.logger.info('Found %s tracks for query %s.', len(tags), query)
+		return tags
 
-		it = self.sdb.Database.QuerySongs(query)
+	def _bulk_read_tags(self, where_clause) -> List[AudioTag]:
+		"""
+		Reads the tags of all songs matching the where clause of a QuerySongs query with a single SQL query.
+		Every returned row is read with a few calls, instead of one COM call per property of every song.
+		Tags read this way do not keep a reference to the SDB song object.
+		"""
+		it = self.sdb.Database.OpenSQL(
+			'SELECT ID, Artist, Album, SongTitle, SongPath, Rating, TrackNumber FROM Songs WHERE ' + where_clause
+		)
 		tags = []
-		counter = 0
+		append_tag = tags.append
+		get_normed_rating = self.get_normed_rating
+		string_by_index = it.StringByIndex
+		value_by_index = it.ValueByIndex
+		next_row = it.Next
 		while not it.EOF:
-			tags.append(self.read_track_metadata(it.Item))
-			counter += 1
-			it.Next()
-
-		self.logger.info(f'Found {counter} tracks for query {query}.')
+			tag = AudioTag(
+				artist=string_by_index(1), album=string_by_index(2), title=string_by_index(3), file_path=string_by_index(4)
+			)
+			tag.rating = get_normed_rating(value_by_index(5))
+			tag.ID = value_by_index(0)
+			tag.track = self._track_order(string_by_index(6))
+			append_tag(tag)
+			next_row()
 		return tags
 
+	def find_tracks(self, ids: Iterable[int]) -> Dict[int, AudioTag]:
+		ids = [int(ID) for ID in ids]
+		tracks = {}
+		for start in range(0, len(ids), self.maximum_ids_per_query):
+			where_clause = 'ID IN ({})'.format(','.join(str(ID) for ID in ids[start:start + self.maximum_ids_per_query]))
+			for tag in self._bulk_read_tags(where_clause):
+				tracks[tag.ID] = tag
+		return tracks
+
+	@staticmethod
+	def _track_order(track_number: str) -> int:
+		"""Converts the TrackNumber text column (e.g. '03' or '3/12') to the number that SDBSongData.TrackOrder returns"""
+		digits = ''
+		for character in track_number.strip():
+			if not character.isdigit():
+				break
+			digits += character
+		return int(digits) if digits else 0
+
 	def update_playlist(self, playlist, track, present):
 		raise NotImplementedError
 
 	def update_rating(self, track, rating):
-		self.logger.debug('Updating rating of track "{}" to {} stars'.format(
-			self.format(track), self.get_5star_rating(rating))
-		)
+		if self.logger.isEnabledFor(logging.DEBUG):
+			self.logger.debug('Updating rating of track "%s" to %s stars', self.format(track), self.get_5star_rating(rating))
 		if not self.dry_run:
-			song = self.sdb.Database.QuerySongs('ID=' + str(track.ID))
-			song.Item.Rating = self.get_native_rating(rating)
-			song.Item.UpdateDB()
+			song = track._sdb_item
+			if song is None:
+				song = self.sdb.Database.QuerySongs('ID=' + str(track.ID)).Item
+			song.Rating = self.get_native_rating(rating)
+			song.UpdateDB()
 
 
 class PlexPlayer(MediaPlayer):
 	# TODO logging needs to be updated to reflect whether Plex is source or destination
+	_name_lower = 'plexplayer'
 	maximum_connection_attempts = 3
+	maximum_concurrent_searches = 20
+	maximum_bulk_edit_size = 100
+	maximum_concurrent_edits = 4
+	maximum_indexed_tracks = 250000
+	near_miss_similarity = 90
+	compound_match_similarity = 90
+	compound_title_similarity = 90
 	rating_maximum = 10
 	album_empty_alias = '[Unknown Album]'
+	cache_directory = os.path.join(os.path.expanduser('~'), '.config', 'plex-music-rating-sync')
 
-	def __init__(self):
+	def __init__(self, maximum_workers: Optional[int] = None):
+		"""
+		:param maximum_workers: the number of threads that match tracks concurrently, each of which may send requests
+		"""
 		super(PlexPlayer, self).__init__()
 		self.logger = logging.getLogger('PlexSync.PlexPlayer')
+		self.maximum_workers = maximum_workers or 0
 		self.account = None
 		self.plex_api_connection = None
 		self.music_library = None
+		self._track_index = None
+		self._track_index_titles = []
+		self._track_index_text = ''
+		self._track_index_offsets = []
+		self._artist_index = None
+		self._library_track_count = None
+		self._track_index_lock = threading.Lock()
+		self._title_search_cache = {}
+		self.session = self.create_session()
 
 	@staticmethod
 	def name():
@@ -260,22 +396,24 @@ class PlexPlayer(MediaPlayer):
 	def format(track):
 		# TODO maybe makes more sense to create a track class and make utility functions for __str__, artist, album, title, etc
 		try:
-			return ' - '.join([track.artist().title, track.album().title, track.title])
-		except TypeError:
+			return ' - '.join([track.grandparentTitle, track.parentTitle, track.title])
+		except AttributeError:
 			return ' - '.join([track.artist, track.album, track.title])
 
 	def connect(self, server, username, password='', token=''):
 		self.logger.info(f'Connecting to the Plex Server {server} with username {username}.')
+		if (not password) & (not token):
+			self.account = self.login_with_cached_token(username)
 		connection_attempts_left = self.maximum_connection_attempts
-		while connection_attempts_left > 0:
-			time.sleep(1)  # important. Otherwise, the above print statement can be flushed after
+		while self.account is None and connection_attempts_left > 0:
 			if (not password) & (not token):
+				self.flush_log()  # important. Otherwise, the above log messages can be flushed after the prompt
 				password = getpass.getpass()
 			try:
 				if (password):
-					self.account = MyPlexAccount(username=username, password=password)
+					self.account = MyPlexAccount(username=username, password=password, session=self.session)
 				elif (token):
-					self.account = MyPlexAccount(username=username, token=token)
+					self.account = MyPlexAccount(username=username, token=token, session=self.session)
 				break
 			except NotFound:
 				print(f'Username {username}, password or token wrong for server {server}.')
@@ -287,42 +425,193 @@ class PlexPlayer(MediaPlayer):
 		if connection_attempts_left == 0 or self.account is None:
 			self.logger.error('Exiting after {} failed attempts ...'.format(self.maximum_connection_attempts))
 			exit(1)
+		if password:
+			self.cache_token(username, self.account.authenticationToken)
 
 		self.logger.info('Connecting to remote player {} on the server {}'.format(self.name(), server))
-		try:
-			self.plex_api_connection = self.account.resource(server).connect(timeout=5)
-			self.logger.info('Successfully connected')
-		except NotFound:
-			# This also happens if the user is not the owner of the server
-			self.logger.error('Error: Unable to connect')
-			exit(1)
-
+		self.plex_api_connection = self.connect_cached_server(username, server)
+		if self.plex_api_connection is None:
+			try:
+				self.plex_api_connection = self.account.resource(server).connect(timeout=5)
+			except NotFound:
+				# This also happens if the user is not the owner of the server
+				self.logger.error('Error: Unable to connect')
+				exit(1)
+			self.cache_server(username, server, self.plex_api_connection)
+		self.logger.info('Successfully connected')
+		self.music_library = self.select_music_library()
+
+	def select_music_library(self) -> plexapi.library.MusicSection:
+		"""Returns the only music library of the server, or asks the user to select one if there are several"""
 		self.logger.info('Looking for music libraries')
-		music_libraries = {
-			section.key:
-				section for section
-				in self.plex_api_connection.library.sections()
-				if section.type == 'artist'}
+		music_libraries = [section for section in self.plex_api_connection.library.sections() if section.type == 'artist']
 
 		if len(music_libraries) == 0:
 			self.logger.error('No music library found')
 			exit(1)
 		elif len(music_libraries) == 1:
-			self.music_library = list(music_libraries.values())[0]
 			self.logger.debug('Found 1 music library')
-		else:
-			print('Found multiple music libraries:')
-			for key, library in music_libraries.items():
-				print('\t[{}]: {}'.format(key, library.title))
+			return music_libraries[0]
+
+		# Only built when there is a choice to make
+		music_libraries = {str(section.key): section for section in music_libraries}
+		self.flush_log()  # Otherwise, the above log messages can be written after the prompt
+		print('Found multiple music libraries:')
+		for key, library in music_libraries.items():
+			print('\t[{}]: {}'.format(key, library.title))
 
-			choice = input('Select the library to sync with: ')
-			self.music_library = music_libraries[int(choice)]
+		choice = input('Select the library to sync with: ')
+		return music_libraries[choice.strip()]
+
+	def create_session(self) -> requests.Session:
+		"""
+		Creates the HTTP session shared by the account and the server connection.
+		Its connections are kept alive and reused, so only the first request pays for the TCP and TLS handshakes.
+		The pool is large enough for all concurrent searches, or all matching threads and the rating edits sent meanwhile,
+		to keep their own connection.
+		"""
+		session = requests.Session()
+		pool_size = max(self.maximum_concurrent_searches, self.maximum_workers + self.maximum_concurrent_edits)
+		adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
+		return session
+
+	def build_track_index(self):
+		"""
+		Fetches all tracks of the music library at once and indexes them by their normalized title.
+		Title searches are then answered from memory instead of with one request to the server per track.
+		Libraries with more than maximum_indexed_tracks tracks are not prefetched, all titles are searched on the server instead.
+		It is built by the first search or lookup that is worth it, see worth_indexing. Further calls do nothing, also from several threads.
+		"""
+		with self._track_index_lock:
+			if self._track_index is not None:
+				return
+			self._title_search_cache = {}
+			n_tracks = self.library_track_count()
+			if n_tracks > self.maximum_indexed_tracks:
+				self.logger.info('The music library {} has too many tracks to prefetch ({} > {}), searching them one by one'.format(
+					self.music_library.title, n_tracks, self.maximum_indexed_tracks
+				))
+				self._track_index = {}
+				return
+
+			self.logger.info('Reading all {} tracks of the music library {}'.format(n_tracks, self.music_library.title))
+			track_index = {}
+			for track in self.music_library.searchTracks():
+				track_index.setdefault(normalize(track.title), []).append(track)
+			self._track_index_titles = list(track_index)
+			# All titles in one string, to find the titles containing a search with str.find. Normalized titles contain no line breaks.
+			self._track_index_text = '\n'.join(self._track_index_titles)
+			self._track_index_offsets = []
+			offset = 0
+			for title in self._track_index_titles:
+				self._track_index_offsets.append(offset)
+				offset += len(title) + 1
+			self._track_index = track_index
+			self.logger.info('Indexed {} distinct track titles'.format(len(track_index)))
+
+	def library_track_count(self) -> int:
+		if self._library_track_count is None:
+			self._library_track_count = self.music_library.totalViewSize(libtype='track')
+		return self._library_track_count
+
+	def worth_indexing(self, n_searches: int) -> bool:
+		"""
+		Whether building the track index takes no more requests than searching @n_searches titles on the server.
+		The index is fetched in pages of plexapi.X_PLEX_CONTAINER_SIZE tracks.
+		"""
+		if self._track_index is not None:
+			return True
+		return n_searches * plexapi.X_PLEX_CONTAINER_SIZE >= self.library_track_count()
+
+	def flush_log(self):
+		"""Writes out all pending messages of the handlers this logger propagates to"""
+		logger = self.logger
+		while logger is not None:
+			for handler in logger.handlers:
+				handler.flush()
+			logger = logger.parent if logger.propagate else None
+		sys.stdout.flush()
+		sys.stderr.flush()
+
+	def cache_path(self, username, suffix):
+		return os.path.join(self.cache_directory, '{}.{}'.format(username, suffix))
+
+	def write_private_file(self, path, content):
+		"""
+		Writes the file so that it is readable only by the current user.
+		The mode of os.open only applies to new files, so the file is restricted again before writing to it.
+		On Windows this only clears the read-only flag, the file is protected by the permissions of the user profile.
+		"""
+		try:
+			os.makedirs(self.cache_directory, exist_ok=True)
+			fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+			with os.fdopen(fd, 'w') as f:
+				os.chmod(path, 0o600)
+				f.write(content)
+		except OSError as error:
+			self.logger.warning('Failed to write the cache file {}: {}'.format(path, error))
+
+	def cache_token(self, username, token):
+		self.write_private_file(self.cache_path(username, 'token'), token)
+
+	def read_cached_servers(self, username) -> Dict[str, dict]:
+		try:
+			with open(self.cache_path(username, 'servers.json')) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {}
+
+	def cache_server(self, username, server, connection: PlexServer):
+		"""Remembers the address and access token of the server connection that was found to work"""
+		servers = self.read_cached_servers(username)
+		servers[server] = {'baseurl': connection._baseurl, 'token': connection._token}
+		self.write_private_file(self.cache_path(username, 'servers.json'), json.dumps(servers))
+
+	def connect_cached_server(self, username, server) -> Optional[PlexServer]:
+		"""
+		Connects directly to the server address cached by a previous run.
+		This skips looking up the server resource on plex.tv and probing all of its connections.
+		:return: the server connection, or None if nothing is cached or the cached address does not work anymore
+		"""
+		cached = self.read_cached_servers(username).get(server)
+		if cached is None:
+			return None
+		try:
+			connection = PlexServer(cached['baseurl'], cached['token'], session=self.session, timeout=5)
+			self.logger.debug('Connected to the cached address {}'.format(cached['baseurl']))
+			return connection
+		except Exception as error:
+			self.logger.info('The cached address of the server {} does not work anymore: {}'.format(server, error))
+			return None
+
+	def login_with_cached_token(self, username) -> Optional[MyPlexAccount]:
+		"""
+		Logs in with the token cached by a previous password login, which skips the password prompt.
+		:return: the account, or None if there is no cached token or it was rejected
+		"""
+		try:
+			with open(self.cache_path(username, 'token')) as f:
+				token = f.read().strip()
+		except OSError:
+			return None
+		if not token:
+			return None
+		try:
+			account = MyPlexAccount(username=username, token=token, session=self.session)
+			self.logger.debug('Logged in with the cached authentication token')
+			return account
+		except (BadRequest, NotFound) as error:
+			self.logger.info('The cached authentication token was rejected: {}'.format(error))
+			return None
 
 	def read_track_metadata(self, track: plexapi.audio.Track) -> AudioTag:
 		tag = AudioTag(artist=track.grandparentTitle, album=track.parentTitle, title=track.title, file_path=track.locations[0])
 		tag.rating = self.get_normed_rating(track.userRating)
 		tag.track = track.index
 		tag.ID = track.key
+		tag._plex_track = track
 		return tag
 
 	def create_playlist(self, title, tracks: List[plexapi.audio.Track]) -> Optional[plexapi.playlist.Playlist]:
@@ -361,10 +650,10 @@ class PlexPlayer(MediaPlayer):
 		if not value:
 			raise ValueError(f"value can not be empty.")
 		if key == "title":
-			matches = self.music_library.searchTracks(title=value)
-			n_matches = len(matches)
-			s_matches = f"match{'es' if n_matches > 1 else ''}"
-			self.logger.debug(f'Found {n_matches} {s_matches} for query title={value}')
+			# A single title is searched on the server, unless the index exists or the library fits in a single page
+			if self.worth_indexing(1):
+				self.build_track_index()
+			matches = self.search_title(value)
 		elif key == "rating":
 			if value is True:
 				value = "0"
@@ -380,6 +669,142 @@ class PlexPlayer(MediaPlayer):
 			raise KeyError(f"Invalid search mode {key}.")
 		return matches
 
+	def search_title(self, title: str) -> List[plexapi.audio.Track]:
+		"""
+		Looks up the titles containing @title in the track index, if it has been built, and searches the server for titles that
+		are not in it. Like the server search, the index returns all titles that contain @title, not just the equal ones.
+		"""
+		key = normalize(title)
+		matches = self.search_index_substrings(key) if self._track_index else []
+		if not matches:
+			matches = self.search_tracks_on_server(title)
+		self.logger.debug('Found %s match%s for query title=%s', len(matches), 'es' if len(matches) > 1 else '', title)
+		return matches
+
+	def search_index_substrings(self, key: str) -> List[plexapi.audio.Track]:
+		"""Looks up the tracks of the index whose normalized titles contain @key, as the title search of the server does"""
+		if not key:
+			return self._track_index.get(key, [])
+		text, offsets, titles = self._track_index_text, self._track_index_offsets, self._track_index_titles
+		matches = []
+		start = text.find(key)
+		while start != -1:
+			i = bisect_right(offsets, start) - 1
+			matches.extend(self._track_index[titles[i]])
+			# Continue with the next title, so that titles containing @key more than once are returned once
+			start = text.find(key, offsets[i + 1]) if i + 1 < len(offsets) else -1
+		return matches
+
+	def search_index_near_misses(self, key: str, track_number) -> List[plexapi.audio.Track]:
+		"""
+		Looks up the tracks of the index whose normalized titles differ only slightly from @key, e.g. by a typo or a missing accent.
+		These titles are not found by the substring search. Since a slightly different title is just as often another track,
+		e.g. "Interlude 2" for "Interlude 1", only tracks with the track number @track_number are returned.
+		"""
+		if track_number is None:
+			return []
+		near_misses = process.extract(
+			key, self._track_index_titles, scorer=fuzz.ratio, processor=None, score_cutoff=self.near_miss_similarity, limit=None
+		)
+		return [
+			track for near_miss, _, _ in near_misses for track in self._track_index[near_miss] if track.index == track_number
+		]
+
+	@staticmethod
+	def compound_key(artist: str, title: str, album: str) -> str:
+		return '{} || {} || {}'.format(artist, title, album)
+
+	def search_similar_tracks(self, track: AudioTag) -> List[plexapi.audio.Track]:
+		"""
+		Looks up the near misses of the title of @track with its track number, see search_index_near_misses.
+		Without any, looks up the track of the index whose normalized artist, title and album together are most similar to those
+		of @track. This finds tracks whose title words are ordered differently than searched, as long as artist and album agree.
+		Since agreeing artists and albums alone let other tracks of the same album through, the title of the track still has
+		to reach compound_title_similarity on its own, and its track number has to be the same.
+		Only the tracks of the same normalized artist are compared, see build_artist_index.
+		"""
+		if not self._track_index:
+			return []
+		near_misses = self.search_index_near_misses(track._title_norm, track.track)
+		if near_misses:
+			return near_misses
+		if track.track is None:
+			return []
+		keys, titles, tracks = self.build_artist_index().get(track._artist_norm, ((), (), ()))
+		similar = process.extract(
+			self.compound_key(track._artist_norm, track._title_norm, track._album_norm), keys,
+			scorer=fuzz.WRatio, processor=None, score_cutoff=self.compound_match_similarity, limit=None
+		)
+		for _, _, index in similar:
+			if tracks[index].index != track.track:
+				continue
+			if fuzz.token_sort_ratio(track._title_norm, titles[index], processor=None) >= self.compound_title_similarity:
+				return [tracks[index]]
+		return []
+
+	def build_artist_index(self) -> Dict[str, Tuple[List[str], List[str], List[plexapi.audio.Track]]]:
+		"""
+		Groups the tracks of the track index by their normalized artist, with the compound key and normalized title of each.
+		The index is built by the first call.
+		"""
+		with self._track_index_lock:
+			if self._artist_index is None:
+				artist_index = {}
+				for title, matches in self._track_index.items():
+					for candidate in matches:
+						artist = normalize(candidate.grandparentTitle)
+						keys, titles, tracks = artist_index.setdefault(artist, ([], [], []))
+						keys.append(self.compound_key(artist, title, normalize(candidate.parentTitle)))
+						titles.append(title)
+						tracks.append(candidate)
+				self._artist_index = artist_index
+			return self._artist_index
+
+	def search_tracks_on_server(self, title: str) -> List[plexapi.audio.Track]:
+		"""Searches the server for tracks whose title contains @title. Results are cached for titles that only differ in case or unicode form."""
+		key = unicodedata.normalize('NFKD', title).casefold()
+		matches = self._title_search_cache.get(key)
+		if matches is None:
+			matches = self._title_search_cache[key] = self.music_library.searchTracks(title=title)
+		return matches
+
+	def search_tracks_many(self, titles: Iterable[str]) -> Dict[str, List[plexapi.audio.Track]]:
+		"""Builds the track index first, unless searching the few titles on the server takes fewer requests"""
+		titles = list(dict.fromkeys(titles))
+		if self.worth_indexing(len(titles)):
+			self.build_track_index()
+		elif titles:
+			self.logger.info('Searching {} titles on the server instead of reading all {} tracks of the music library {}'.format(
+				len(titles), self.library_track_count(), self.music_library.title
+			))
+		with ThreadPoolExecutor(max_workers=self.maximum_concurrent_searches) as executor:
+			matches = executor.map(self.search_title, titles)
+			return dict(zip(titles, matches))
+
+	def track_id(self, track: plexapi.audio.Track) -> int:
+		return track.ratingKey
+
+	def find_tracks(self, ids: Iterable[int]) -> Dict[int, plexapi.audio.Track]:
+		"""Takes the tracks from the track index where possible and fetches the others with one request per maximum_bulk_edit_size tracks"""
+		wanted = set(ids)
+		if self.worth_indexing(len(wanted) // self.maximum_bulk_edit_size + 1):
+			self.build_track_index()
+		tracks = {}
+		for matches in (self._track_index or {}).values():
+			for track in matches:
+				if track.ratingKey in wanted:
+					tracks[track.ratingKey] = track
+		missing = [key for key in wanted if key not in tracks]
+		for start in range(0, len(missing), self.maximum_bulk_edit_size):
+			keys = ','.join(str(key) for key in missing[start:start + self.maximum_bulk_edit_size])
+			try:
+				for track in self.plex_api_connection.fetchItems('/library/metadata/{}'.format(keys)):
+					if isinstance(track, plexapi.audio.Track):
+						tracks[track.ratingKey] = track
+			except NotFound:
+				pass
+		return tracks
+
 	def update_playlist(self, playlist, track, present):
 		"""
 		:type playlist: plexapi.playlist.Playlist
@@ -388,21 +813,59 @@ class PlexPlayer(MediaPlayer):
 		:return:
 		"""
 		if present:
-			self.logger.debug('Adding {} to playlist {}'.format(self.format(track), playlist.title))
+			self.logger.debug('Adding %s to playlist %s', self.format(track), playlist.title)
 			if not self.dry_run:
 				playlist.addItems(track)
 		else:
-			self.logger.debug('Removing {} from playlist {}'.format(self.format(track), playlist.title))
+			self.logger.debug('Removing %s from playlist %s', self.format(track), playlist.title)
 			if not self.dry_run:
 				playlist.removeItem(track)
 
+	def add_to_playlist(self, playlist, tracks: List[plexapi.audio.Track]):
+		"""Adds all tracks to the playlist with a single request, unless in dry run"""
+		if not tracks:
+			return
+		if self.logger.isEnabledFor(logging.DEBUG):
+			for track in tracks:
+				self.logger.debug('Adding %s to playlist %s', self.format(track), playlist.title)
+		if not self.dry_run:
+			playlist.addItems(tracks)
+
 	def update_rating(self, track, rating):
-		self.logger.debug('Updating rating of track "{}" to {} stars'.format(
-			self.format(track), self.get_5star_rating(rating))
-		)
+		track = getattr(track, '_plex_track', None) or track
+		if isinstance(track, plexapi.audio.Track):
+			self.update_ratings_bulk([(track, rating)])
+			return
+		if self.logger.isEnabledFor(logging.DEBUG):
+			self.logger.debug('Updating rating of track "%s" to %s stars', self.format(track), self.get_5star_rating(rating))
 		if not self.dry_run:
-			try:
-				track.edit(**{'userRating.value': self.get_native_rating(rating)})
-			except AttributeError:
-				song = [s for s in self.music_library.searchTracks(title=track.title) if s.key == track.ID][0]
-				song.edit(**{'userRating.value': self.get_native_rating(rating)})
+			song = [s for s in self.music_library.searchTracks(title=track.title) if s.key == track.ID][0]
+			song.edit(**{'userRating.value': self.get_native_rating(rating)})
+
+	def update_ratings_bulk(self, updates: List[Tuple[plexapi.audio.Track, float]]):
+		"""Updates all tracks that receive the same rating with a single request to the server, unless in dry run"""
+		tracks_by_rating = {}
+		for track, rating in updates:
+			track = getattr(track, '_plex_track', None) or track
+			if isinstance(track, plexapi.audio.Track):
+				tracks_by_rating.setdefault(rating, []).append(track)
+			else:
+				self.update_rating(track, rating)
+
+		queries = []
+		for rating, tracks in tracks_by_rating.items():
+			if self.logger.isEnabledFor(logging.DEBUG):
+				for track in tracks:
+					self.logger.debug('Updating rating of track "%s" to %s stars', self.format(track), self.get_5star_rating(rating))
+			for start in range(0, len(tracks), self.maximum_bulk_edit_size):
+				params = {
+					'type': 10,  # track
+					'id': ','.join(str(track.ratingKey) for track in tracks[start:start + self.maximum_bulk_edit_size]),
+					'userRating.value': self.get_native_rating(rating),
+				}
+				queries.append('/library/sections/{}/all?{}'.format(self.music_library.key, urlencode(params)))
+		if self.dry_run or not queries:
+			return
+		# Fewer writers than searchers, so that the server is not flooded with edits
+		with ThreadPoolExecutor(max_workers=self.maximum_concurrent_edits) as executor:
+			list(executor.map(lambda query: self.plex_api_connection.query(query, method=self.plex_api_connection._session.put), queries))
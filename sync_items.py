@@ -1,7 +1,48 @@
-from typing import List
+from typing import List, Optional
+import unicodedata
+
+import numpy as np
+
+
+class _PunctuationTable(dict):
+	"""
+	Maps all unicode punctuation, e.g. typographic quotes and dashes, to None for str.translate.
+	The category of every character is looked up once, when it is first translated.
+	"""
+	def __missing__(self, codepoint):
+		self[codepoint] = None if unicodedata.category(chr(codepoint)).startswith('P') else codepoint
+		return self[codepoint]
+
+
+_NORMALIZATION_TABLE = _PunctuationTable()
+
+
+def normalize(text: Optional[str]) -> str:
+	"""
+	Folds case, removes punctuation and collapses whitespace, so that only differences that matter are left for fuzzy matching.
+	The words of the result are separated by single spaces, as in the token sorted string that token_sort_ratio compares.
+	"""
+	if not text:
+		return ''
+	return ' '.join(text.translate(_NORMALIZATION_TABLE).casefold().split())
+
+
+def char_mask(text: str) -> int:
+	"""
+	Maps the characters of @text to the bits of a 64 bit mask, so that two character sets can be compared with a single
+	bitwise operation. Characters that share their lowest 6 bits share a bit.
+	"""
+	mask = 0
+	for c in set(text):
+		mask |= 1 << (ord(c) & 63)
+	return mask
 
 
 class AudioTag(object):
+	__slots__ = (
+		'artist', 'album', 'title', 'rating', 'genre', 'file_path', 'ID', 'track', '_sdb_item', '_plex_track',
+		'_artist_norm', '_album_norm', '_title_norm', '_title_mask'
+	)
 
 	def __init__(self, artist='', album='', title='', file_path=None):
 		self.album = album
@@ -10,12 +51,21 @@ class AudioTag(object):
 		self.rating = 0
 		self.genre = ''
 		self.file_path = file_path
+		self.ID = None
+		self.track = None
+		self._sdb_item = None
+		self._plex_track = None
+		self._artist_norm = normalize(artist)
+		self._album_norm = normalize(album)
+		self._title_norm = normalize(title)
+		self._title_mask = char_mask(self._title_norm)
 
 	def __str__(self):
-		return ' - '.join([self.artist, self.album, self.title])
+		return f'{self.artist} - {self.album} - {self.title}'
 
 
 class Playlist(object):
+	__slots__ = ('name', 'tracks', 'is_auto_playlist')
 
 	def __init__(self, name, parent_name=''):
 		"""
@@ -35,3 +85,28 @@ class Playlist(object):
 
 	def __str__(self):
 		return '{}: {} tracks'.format(self.name, self.num_tracks)
+
+
+class TrackTable(object):
+	"""
+	Stores the fields of several candidate tracks that matching compares column by column,
+	so that all values of a field can be compared in a single vectorized call.
+	"""
+	__slots__ = ('tracks', 'titles', 'artists', 'albums', 'numbers', 'albums_empty')
+
+	def __init__(self, tracks, fields):
+		"""
+		:param tracks: the tracks native to a player, in the same order as @fields
+		:param fields: the normalized title, artist and album, the track number and whether both albums are empty of every track,
+			as returned by TrackPair.candidate_fields
+		"""
+		self.tracks = tracks
+		titles, artists, albums, numbers, albums_empty = zip(*fields) if fields else ((), (), (), (), ())
+		self.titles = list(titles)
+		self.artists = list(artists)
+		self.albums = list(albums)
+		self.numbers = np.array(numbers, dtype=object)
+		self.albums_empty = np.array(albums_empty, dtype=bool)
+
+	def __len__(self):
+		return len(self.tracks)
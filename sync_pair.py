@@ -1,11 +1,43 @@
 import abc
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
-from fuzzywuzzy import fuzz
+from rapidfuzz import fuzz, process
 import logging
 import numpy as np
+from operator import attrgetter
 
 from MediaPlayer import MediaPlayer
-from sync_items import Playlist, AudioTag
+from sync_items import Playlist, AudioTag, TrackTable, char_mask, normalize
+
+
+# Accessors for the artist, album and track number of a destination track, depending on whether it is a plexapi track or an AudioTag
+_PLEX_TRACK_FIELDS = (attrgetter('grandparentTitle'), attrgetter('parentTitle'), attrgetter('index'))
+_AUDIO_TAG_FIELDS = (attrgetter('artist'), attrgetter('album'), attrgetter('track'))
+
+
+# Compares the fields of two tracks independent of the order of their words, e.g. "Beatles The" and "The Beatles"
+_SCORER = fuzz.token_sort_ratio
+
+
+def _ratio(a, b, score_cutoff=0):
+	"""_SCORER of two normalized strings, without the edit distance computation if they are equal or cannot reach @score_cutoff"""
+	if a == b:
+		return 100.
+	if score_cutoff and _ratio_bound(a, b) < score_cutoff:
+		return 0.
+	return _SCORER(a, b, processor=None, score_cutoff=score_cutoff)
+
+
+def _ratio_bound(a, b):
+	"""
+	Upper bound of _SCORER(a, b) from the string lengths alone.
+	At most the characters of the shorter string can be matched, so the ratio is at most 2 * min / (len(a) + len(b)).
+	Sorting the words of a normalized string does not change its length, so the bound holds for token_sort_ratio as well.
+	"""
+	total = len(a) + len(b)
+	if total == 0:
+		return 100.
+	return 200. * min(len(a), len(b)) / total
 
 
 class SyncState(Enum):
@@ -52,8 +84,16 @@ class SyncPair(abc.ABC):
 
 
 class TrackPair(SyncPair):
+	# Shared by all pairs, there can be one pair per track of the library
+	logger = logging.getLogger('PlexSync.TrackPair')
+	batch_similarity_threshold = 8
+	prefilter_similarity = 0.4
+	# Without artist and album only the title can confirm a match, so it has to be nearly the same
+	title_match_similarity = 90
 	rating_source = 0.0
 	rating_destination = 0.0
+	# Whether the destination was found by search_similar_tracks or matched by its title alone. Such matches are not cached.
+	similar_match = False
 
 	def __init__(self, source_player, destination_player, source_track: AudioTag):
 		# """
@@ -62,34 +102,31 @@ class TrackPair(SyncPair):
 		# :type remote_player: MediaPlayer.PlexPlayer
 		# """
 		super(TrackPair, self).__init__(source_player, destination_player)
-		self.logger = logging.getLogger('PlexSync.TrackPair')
 		self.source = source_track
+		self._dest_is_plex = destination_player.name() == "PlexPlayer"
+		self._get_artist, self._get_album, self._get_track = _PLEX_TRACK_FIELDS if self._dest_is_plex else _AUDIO_TAG_FIELDS
+		self._source_album_empty = source_player.album_empty(source_track.album)
 
-	def albums_similarity(self, destination=None):
+	def albums_similarity(self, destination=None, score_cutoff=0):
 		"""
 		Determines how similar two album names are. It takes into account different conventions for empty album names.
 		:type destination: str
 			optional album title to compare the album name of the source track with
+		:param score_cutoff: similarities below this are returned as 0
 		:returns a similarity rating [0, 100]
 		:rtype: int
 		"""
 		if destination is None:
 			destination = self.destination
-		if self.both_albums_empty(destination=destination):
+		album = normalize(self._get_album(destination))
+		if album == self.source._album_norm or self.both_albums_empty(destination=destination):
 			return 100
-		else:
-			if self.destination_player.name() == "PlexPlayer":
-				return fuzz.ratio(self.source.album, destination.album().title)
-			else:
-				return fuzz.ratio(self.source.album, destination.album)
+		return _ratio(self.source._album_norm, album, score_cutoff=score_cutoff)
 
 	def both_albums_empty(self, destination=None):
 		if destination is None:
 			destination = self.destination
-		if self.destination_player.name() == "PlexPlayer":
-			return self.source_player.album_empty(self.source.album) and self.destination_player.album_empty(destination.album().title)
-		else:
-			return self.source_player.album_empty(self.source.album) and self.destination_player.album_empty(destination.album)
+		return self._source_album_empty and self.destination_player.album_empty(self._get_album(destination))
 
 	def match(self, candidates=None, match_threshold=30):
 		# TODO: threshold should be configurable
@@ -103,33 +140,50 @@ class TrackPair(SyncPair):
 				self.logger.error(f"Failed to search tracks for track '{self.source}' stored at {self.source.file_path}.")
 				raise e
 
+		self.similar_match = False
+		if len(candidates) == 0:
+			# The title may be tagged differently by the destination player, compare artist, title and album together instead
+			candidates = self.destination_player.search_similar_tracks(self.source)
+			self.similar_match = len(candidates) > 0
 		if len(candidates) == 0:
 			self.sync_state = SyncState.ERROR
-			self.logger.warning('No match found for {}'.format(self.source))
+			self.logger.warning('No match found for %s', self.source)
 			return 0
-		scores = np.array([self.similarity(candidate) for candidate in candidates])
-		ranks = scores.argsort()
-		score = scores[ranks[-1]]
+		fields = [self.candidate_fields(candidate) for candidate in candidates]
+		candidates, fields = self.prefilter(candidates, fields)
+		best = self.exact_match(fields)
+		if best is not None:
+			score = 100.
+		elif not self.source._artist_norm and not self.source._album_norm:
+			best, score = self.title_match(fields, max(match_threshold, self.title_match_similarity))
+			self.similar_match = True
+		else:
+			# A field scoring below this cannot reach the threshold, even if the other three fields score 100
+			score_cutoff = max(0, 4 * match_threshold - 300)
+			if len(candidates) >= self.batch_similarity_threshold:
+				scores = self.batch_similarity(TrackTable(candidates, fields), score_cutoff=score_cutoff)
+				best = int(scores.argmax())
+				score = scores[best]
+			else:
+				best, score = self.best_similarity(candidates, fields, score_cutoff, match_threshold)
 		if score < match_threshold:
 			self.sync_state = SyncState.ERROR
-			self.logger.debug('Score of best candidate {} is too low: {} < {}'.format(
-				self.destination_player.format(candidates[ranks[-1]]), score, match_threshold
-			))
+			if self.logger.isEnabledFor(logging.DEBUG):
+				self.logger.debug(
+					'Score of best candidate %s is too low: %s < %s', self.destination_player.format(candidates[best]), score, match_threshold
+				)
 			return score
 
-		self.destination = candidates[ranks[-1]]
-		self.logger.debug('Found match with score {} for {}: {}'.format(
-			score, self.source, self.destination_player.format(self.destination)
-		))
+		self.destination = candidates[best]
 		if score != 100:
-			self.logger.info('Found match with score {} for {}: {}'.format(
-				score, self.source, self.destination_player.format(self.destination)
-			))
+			self.logger.info('Found match with score %s for %s: %s', score, self.source, self.destination_player.format(self.destination))
+		elif self.logger.isEnabledFor(logging.DEBUG):
+			self.logger.debug('Found match with score %s for %s: %s', score, self.source, self.destination_player.format(self.destination))
 
 		self.rating_source = self.source.rating
 
 		# TODO make this a class method so that all code to get rating is standard
-		if self.destination_player.name() == "PlexPlayer":
+		if self._dest_is_plex:
 			self.rating_destination = self.destination_player.get_normed_rating(self.destination.userRating)
 		else:
 			self.rating_destination = self.destination.rating
@@ -140,12 +194,21 @@ class TrackPair(SyncPair):
 			self.sync_state = SyncState.NEEDS_UPDATE
 		elif self.rating_source != self.rating_destination:
 			self.sync_state = SyncState.CONFLICTING
-			self.logger.warning('Found match with conflicting ratings: {} (Source: {} | Destination: {})'.format(
-				self.source, self.rating_source, self.rating_destination)
+			self.logger.warning(
+				'Found match with conflicting ratings: %s (Source: %s | Destination: %s)', self.source, self.rating_source, self.rating_destination
 			)
 
 		return score
 
+	def reverse_direction(self):
+		"""
+		Swaps source and destination, so that the rating of the destination track is synchronized to the source track.
+		The fields derived for matching still describe the original direction, the pair is not meant to be matched again.
+		"""
+		self.source, self.destination = self.destination, self.source
+		self.source_player, self.destination_player = self.destination_player, self.source_player
+		self.rating_source, self.rating_destination = self.rating_destination, self.rating_source
+
 	def resolve_conflict(self):
 		prompt = {
 			"1": "{}: ({}) - Rating: {}".format(self.source_player.name(), self.source, self.rating_source),
@@ -196,29 +259,167 @@ class TrackPair(SyncPair):
 		print('you chose {} which is {}'.format(choice, prompt[choice]))
 		return NotImplemented
 
-	def similarity(self, candidate):
+	def candidate_fields(self, candidate):
+		"""
+		Reads the fields of @candidate that matching compares, so that they are read and normalized only once per candidate
+		:returns the normalized title, artist and album, the track number and whether both albums are empty
+		:rtype: tuple
+		"""
+		album = self._get_album(candidate)
+		return (
+			normalize(candidate.title),
+			normalize(self._get_artist(candidate)),
+			normalize(album),
+			self._get_track(candidate),
+			self._source_album_empty and self.destination_player.album_empty(album)
+		)
+
+	def prefilter(self, candidates, fields):
+		"""
+		Drops the candidates whose titles share too few characters with the source title before any fuzzy matching.
+		The character sets are compared as bit masks: the number of common bits relative to the number of bits set in either
+		mask has to exceed prefilter_similarity. If no candidate passes, all of them are kept, so the best one can still be
+		reported.
+		Candidates whose artist, album or track number equal those of the source track are always kept, whatever their title.
+		A title with a suffix, e.g. "Run - Live at Wembley 1986" for "Run", shares few characters with the source title but
+		can still be the best match.
+		:param fields: the candidate_fields of each candidate
+		:returns the kept candidates and their fields
+		"""
+		source = self.source
+		source_mask = source._title_mask
+		if not source_mask:
+			return candidates, fields
+		kept_candidates, kept_fields = [], []
+		for candidate, candidate_fields in zip(candidates, fields):
+			title, artist, album, track, albums_empty = candidate_fields
+			mask = char_mask(title)
+			if (
+				artist == source._artist_norm or album == source._album_norm or albums_empty or track == source.track or
+				bin(mask & source_mask).count('1') > self.prefilter_similarity * bin(mask | source_mask).count('1')
+			):
+				kept_candidates.append(candidate)
+				kept_fields.append(candidate_fields)
+		if not kept_candidates:
+			return candidates, fields
+		return kept_candidates, kept_fields
+
+	def exact_match(self, fields):
+		"""
+		Finds the first candidate whose normalized title, artist and album as well as track number equal those of the source
+		track. Such a candidate gets the maximum similarity, so it can be taken without scoring any candidate.
+		:param fields: the candidate_fields of each candidate
+		:returns the index of the candidate, or None
+		"""
+		source = self.source
+		for i, (title, artist, album, track, _) in enumerate(fields):
+			if title == source._title_norm and artist == source._artist_norm and track == source.track and album == source._album_norm:
+				return i
+		return None
+
+	def title_match(self, fields, score_cutoff=0):
+		"""
+		Finds the candidate with the most similar title, for source tracks without artist and album.
+		Those fields cannot tell the candidates apart, so the titles are compared with a single call into RapidFuzz.
+		Of several candidates with the best title, the one with the track number of the source track is preferred.
+		:param fields: the candidate_fields of each candidate
+		:returns the index of the best candidate and its similarity [0.0, 100.0], which is 0 if no title reaches @score_cutoff
+		:rtype: tuple
+		"""
+		scores = process.cdist(
+			[self.source._title_norm], [title for title, _, _, _, _ in fields], scorer=_SCORER, processor=None, score_cutoff=score_cutoff
+		)[0]
+		best = int(scores.argmax())
+		score = scores[best]
+		if score == 0:
+			return 0, 0.
+		ties = np.flatnonzero(scores == score)
+		if len(ties) > 1:
+			for index in ties:
+				if fields[index][3] == self.source.track:
+					return int(index), score
+			self.logger.info('%s candidates with the title of %s, none with its track number, taking the first', len(ties), self.source)
+		return best, score
+
+	def best_similarity(self, candidates, fields, score_cutoff=0, minimum_score=0):
+		"""
+		Scores the candidates one after another. Each candidate only has to beat the best one so far, so candidates that
+		cannot are abandoned early. For equal scores the first candidate wins, like with argmax.
+		:param fields: the candidate_fields of each candidate
+		:param minimum_score: candidates below this similarity count as 0
+		:returns the index of the best candidate and its similarity [0.0, 100.0]
+		:rtype: tuple
+		"""
+		best, best_score = 0, 0.
+		for i, (candidate, candidate_fields) in enumerate(zip(candidates, fields)):
+			score = self.similarity(
+				candidate, score_cutoff=score_cutoff, fields=candidate_fields, minimum_score=max(minimum_score, best_score)
+			)
+			if score > best_score:
+				best, best_score = i, score
+		return best, best_score
+
+	def similarity(self, candidate, score_cutoff=0, fields=None, minimum_score=0):
 		"""
 		Determines the matching similarity of @candidate with the source query track
 		:type candidate: Track
+		:param score_cutoff: string fields with a similarity below this count as 0
+		:param fields: the candidate_fields of @candidate, read from it if not given
+		:param minimum_score: candidates that cannot reach this similarity get 0, often without comparing all strings
 		:returns a similarity rating [0.0, 100.0]
 		:rtype: float
 		"""
-		if self.destination_player.name() == "PlexPlayer":
-			scores = np.array([
-				fuzz.ratio(self.source.title, candidate.title),
-				fuzz.ratio(self.source.artist, candidate.artist().title),
-				100. if self.source.track == candidate.index else 0.,
-				self.albums_similarity(destination=candidate)])
-		else:
-			scores = np.array([
-				fuzz.ratio(self.source.title, candidate.title),
-				fuzz.ratio(self.source.artist, candidate.artist),
-				100. if self.source.track == candidate.track else 0.,
-				self.albums_similarity(destination=candidate)])
-		return np.average(scores)
+		title, artist, album, track, albums_empty = fields or self.candidate_fields(candidate)
+		source = self.source
+		track_score = 100. if source.track == track else 0.
+		if not minimum_score:
+			album_score = 100 if albums_empty else _ratio(source._album_norm, album, score_cutoff=score_cutoff)
+			return (
+				_ratio(source._title_norm, title, score_cutoff=score_cutoff) +
+				_ratio(source._artist_norm, artist, score_cutoff=score_cutoff) +
+				track_score +
+				album_score
+			) * 0.25
+
+		# The fields are scored one after another and the candidate is abandoned as soon as the scores so far plus the
+		# length bounds of the remaining fields cannot reach minimum_score anymore
+		minimum_total = 4 * minimum_score
+		artist_bound = _ratio_bound(source._artist_norm, artist)
+		album_bound = 100. if albums_empty else _ratio_bound(source._album_norm, album)
+		if _ratio_bound(source._title_norm, title) + artist_bound + track_score + album_bound < minimum_total:
+			return 0.
+		title_score = _ratio(source._title_norm, title, score_cutoff=score_cutoff)
+		if title_score + artist_bound + track_score + album_bound < minimum_total:
+			return 0.
+		artist_score = _ratio(source._artist_norm, artist, score_cutoff=score_cutoff)
+		if title_score + artist_score + track_score + album_bound < minimum_total:
+			return 0.
+		album_score = 100 if albums_empty else _ratio(source._album_norm, album, score_cutoff=score_cutoff)
+		return (title_score + artist_score + track_score + album_score) * 0.25
+
+	def batch_similarity(self, table, score_cutoff=0):
+		"""
+		Determines the matching similarity of all candidates of @table at once. The result is the same as calling similarity for
+		each candidate, but every string field is compared in a single call into RapidFuzz.
+		:type table: TrackTable
+		:param score_cutoff: string fields with a similarity below this count as 0
+		:returns similarity ratings [0.0, 100.0]
+		:rtype: np.ndarray
+		"""
+		title_scores = process.cdist([self.source._title_norm], table.titles, scorer=_SCORER, processor=None, score_cutoff=score_cutoff, dtype=np.float64)[0]
+		artist_scores = process.cdist([self.source._artist_norm], table.artists, scorer=_SCORER, processor=None, score_cutoff=score_cutoff, dtype=np.float64)[0]
+		track_scores = np.where(table.numbers == self.source.track, 100., 0.)
+		album_scores = process.cdist([self.source._album_norm], table.albums, scorer=_SCORER, processor=None, score_cutoff=score_cutoff, dtype=np.float64)[0]
+		if self._source_album_empty:
+			album_scores[table.albums_empty] = 100.
+		return (title_scores + artist_scores + track_scores + album_scores) * 0.25
+
+	def needs_sync(self, force=False):
+		"""Whether sync would propagate the source rating to the destination track"""
+		return self.rating_destination <= 0.0 or force
 
 	def sync(self, force=False):
-		if self.rating_destination <= 0.0 or force:
+		if self.needs_sync(force):
 			# Propagate the rating of the source track to the destination track
 			self.destination_player.update_rating(self.destination, self.rating_source)
 		else:
@@ -228,24 +429,32 @@ class TrackPair(SyncPair):
 
 class PlaylistPair(SyncPair):
 	# TODO: finish implementing playlist sync for MediaMonkey -> Plexfo
+	maximum_workers = 16
 	remote: [Playlist]
 
-	def __init__(self, local_player, remote_player, local_playlist):
+	def __init__(self, local_player, remote_player, local_playlist, matches=None, maximum_workers=None):
 		"""
 		:type local_player: MediaPlayer.MediaPlayer
 		:type remote_player: MediaPlayer.PlexPlayer
 		:type local_playlist: Playlist
+		:param matches: the remote tracks that local tracks were already matched with, by the ID of the local track.
+			Tracks matched while synchronizing this playlist are added to it.
+		:type matches: dict
+		:param maximum_workers: the number of threads matching the tracks of the playlist, maximum_workers if not given
 		"""
 		super(PlaylistPair, self).__init__(local_player, remote_player)
 		self.logger = logging.getLogger('PlexSync.TrackPair')
 		self.local = local_playlist
+		self.matches = {} if matches is None else matches
+		if maximum_workers is not None:
+			self.maximum_workers = maximum_workers
 
 	def match(self):
 		"""
 		If the local playlist does not exist on the remote player, create it
 		:return: None
 		"""
-		self.remote = self.remote_player.find_playlist(title=self.local.name)
+		self.remote = self.destination_player.find_playlist(title=self.local.name)
 
 	def resolve_conflict(self):
 		raise NotImplementedError
@@ -261,17 +470,30 @@ class PlaylistPair(SyncPair):
 		:rtype: bool
 		"""
 		self.logger.info('Synchronizing playlist {}'.format(self.local.name))
-		track_pairs = [TrackPair(self.local_player, self.remote_player, track) for track in self.local.tracks]
+		track_pairs = [TrackPair(self.source_player, self.destination_player, track) for track in self.local.tracks]
+		unmatched_pairs = []
 		for pair in track_pairs:
-			pair.match()
+			pair.destination = self.matches.get(pair.source.ID)
+			if pair.destination is None:
+				unmatched_pairs.append(pair)
+		# Tracks without a title are left to TrackPair.match, which reports them
+		candidates = self.destination_player.search_tracks_many(pair.source.title for pair in unmatched_pairs if pair.source.title)
+		# Matching only modifies the pair itself, so the pairs can be scored concurrently
+		with ThreadPoolExecutor(max_workers=self.maximum_workers) as executor:
+			list(executor.map(lambda pair: pair.match(candidates=candidates.get(pair.source.title)), unmatched_pairs))
+		for pair in unmatched_pairs:
+			if pair.destination is not None:
+				self.matches[pair.source.ID] = pair.destination
 
 		if self.remote is None:  # create a new playlist with all tracks
-			remote_tracks = [pair.remote for pair in track_pairs if pair.remote is not None]
-			self.remote = self.remote_player.create_playlist(self.local.name, remote_tracks)
+			remote_tracks = [pair.destination for pair in track_pairs if pair.destination is not None]
+			self.remote = self.destination_player.create_playlist(self.local.name, remote_tracks)
 		else:  # playlist already exists, check which items need to be updated
-			remote_tracks = self.remote.items()
+			present = {track.ratingKey for track in self.remote.items()}
+			missing = {}
 			for pair in track_pairs:
-				if pair.remote not in remote_tracks:
-					self.remote_player.update_playlist(self.remote, pair.remote, True)
+				if pair.destination is not None and pair.destination.ratingKey not in present:
+					missing.setdefault(pair.destination.ratingKey, pair.destination)
+			self.destination_player.add_to_playlist(self.remote, list(missing.values()))
 
 		return True
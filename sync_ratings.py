@@ -1,21 +1,39 @@
 #!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from typing import Optional
 
+import argparse
+import atexit
 import configargparse
+import json
 import locale
 import logging
+import logging.handlers
+import queue
 import sys
 
 from sync_pair import TrackPair, SyncState, PlaylistPair
 from MediaPlayer import MediaMonkey, MediaPlayer, PlexPlayer
 
+# The local players that can be selected with --player, by their lower case name
+_SUPPORTED_PLAYERS = {player.name().lower(): player for player in (MediaMonkey,)}
+
 
 class InfoFilter(logging.Filter):
 	def filter(self, rec):
 		return rec.levelno in (logging.DEBUG, logging.INFO)
 
 
+class FlushingQueueHandler(logging.handlers.QueueHandler):
+	def flush(self):
+		# Waits until the listener has written out every record queued so far
+		self.queue.join()
+
+
 class PlexSync:
+	maximum_workers = 16
+	sync_chunk_size = 500
 	log_levels = {
 		'CRITICAL': logging.CRITICAL,
 		'ERROR': logging.ERROR,
@@ -28,30 +46,37 @@ class PlexSync:
 		self.logger = logging.getLogger('PlexSync')
 		self.options = options
 		self.setup_logging()
+		if self.options.max_workers is not None:
+			self.maximum_workers = self.options.max_workers
+		# What each item of --sync synchronizes, and how
+		self._sync_dispatch = {
+			"tracks": ('track ratings', self.sync_tracks),
+			"playlists": ('playlists', self.sync_playlists)
+		}
 		self.source_player: Optional[MediaPlayer] = None
 		self.destination_player: Optional[MediaPlayer] = None
 		if self.options.reverse:
-			self.source_player = PlexPlayer()
+			self.source_player = PlexPlayer(maximum_workers=self.maximum_workers)
 			self.destination_player = self.get_player()
 		else:
 			self.source_player = self.get_player()
-			self.destination_player = PlexPlayer()
+			self.destination_player = PlexPlayer(maximum_workers=self.maximum_workers)
 		self.source_player.dry_run = self.destination_player.dry_run = self.options.dry
 		self.conflicts = []
+		# The destination tracks matched by sync_tracks by the ID of their source track, for sync_playlists to reuse
+		self.matched_destinations = {}
 		self.updates = []
 
 	def get_player(self):
 		"""
 		:rtype: MediaPlayer
 		"""
-		_player = self.options.player.lower()
-		supported_players = {MediaMonkey.name()}
-		if _player == MediaMonkey.name().lower():
-			return MediaMonkey()
-		else:
-			self.logger.error('Valid players: {}'.format(', '.join(supported_players)))
+		player = _SUPPORTED_PLAYERS.get(self.options.player.lower())
+		if player is None:
+			self.logger.error('Valid players: {}'.format(', '.join(player.name() for player in _SUPPORTED_PLAYERS.values())))
 			self.logger.error('Unsupported player selected: {}'.format(self.options.player))
 			exit(1)
+		return player()
 
 	def setup_logging(self):
 		self.logger.setLevel(logging.DEBUG)
@@ -67,13 +92,11 @@ class PlexSync:
 		fh = logging.FileHandler(filename='sync_ratings.log', encoding='utf-8', mode='w')
 		fh.setLevel(logging.DEBUG)
 		fh.setFormatter(formatter_explicit)
-		self.logger.addHandler(fh)
 
 		# Set up the error / warning command line logger
 		ch_err = logging.StreamHandler(stream=sys.stderr)
 		ch_err.setFormatter(formatter_explicit)
 		ch_err.setLevel(logging.WARNING)
-		self.logger.addHandler(ch_err)
 
 		# Set up the verbose info / debug command line logger
 		ch_std = logging.StreamHandler(stream=sys.stdout)
@@ -96,7 +119,23 @@ class PlexSync:
 			raise RuntimeError('Invalid logging level selected: {}'.format(level))
 		else:
 			ch_std.setLevel(level)
-			self.logger.addHandler(ch_std)
+
+		# The records are still formatted on the calling thread, but written to the file and the console on a background thread
+		log_queue = queue.Queue()
+		self.log_handler = FlushingQueueHandler(log_queue)
+		self.logger.addHandler(self.log_handler)
+		self.log_listener = logging.handlers.QueueListener(log_queue, fh, ch_err, ch_std, respect_handler_level=True)
+		self.log_listener.start()
+		atexit.register(self.stop_logging)
+
+	def flush_logs(self):
+		"""Writes out all queued log records, e.g. before prompting the user so that the prompt is not interleaved with them."""
+		self.log_handler.flush()
+
+	def stop_logging(self):
+		"""Writes out all queued log records and stops the listener. Records logged afterwards are dropped."""
+		self.logger.removeHandler(self.log_handler)
+		self.log_listener.stop()
 
 	def sync(self):
 		if self.options.reverse:
@@ -117,89 +156,226 @@ class PlexSync:
 			self.source_player.connect()
 
 		for sync_item in self.options.sync:
-			if sync_item.lower() == "tracks":
-				self.logger.info('Starting to sync track ratings from {} to {}'.format(self.source_player.name(), self.destination_player.name()))
-				self.sync_tracks()
-			elif sync_item.lower() == "playlists":
-				# TODO: finish implementing playlist sync for MediaMonkey -> Plex
-				if not self.options.reverse:
-					self.logger.info('Starting to sync playlists from {} to {}'.format(self.source_player.name(), self.destination_player.name()))
-					self.sync_playlists()
-			else:
+			if sync_item not in self._sync_dispatch:
 				raise ValueError('Invalid sync item selected: {}'.format(sync_item))
+			# TODO: finish implementing playlist sync for MediaMonkey -> Plex
+			if sync_item == "playlists" and self.options.reverse:
+				continue
+			description, sync = self._sync_dispatch[sync_item]
+			self.logger.info('Starting to sync {} from {} to {}'.format(description, self.source_player.name(), self.destination_player.name()))
+			sync()
 
 	def sync_tracks(self):
 		tracks = self.source_player.search_tracks(key="rating", value=True)
 		self.logger.info('Attempting to match {} tracks'.format(len(tracks)))
-		sync_pairs = [TrackPair(self.source_player, self.destination_player, track) for track in tracks]
 
+		if self.options.dry:
+			self.logger.info('Running a DRY RUN. No changes will be propagated!')
 		self.logger.info('Matching source tracks with destination player')
+		cached_destinations = self.read_match_cache(tracks)
+		self.logger.info('Found {} cached matches'.format(sum(1 for destination in cached_destinations if destination is not None)))
+		# Tracks without a title are left to TrackPair.match, which reports them
+		candidates = self.destination_player.search_tracks_many(
+			track.title for track, destination in zip(tracks, cached_destinations) if track.title and destination is None
+		)
+
+		def match(track, cached_destination):
+			pair = TrackPair(self.source_player, self.destination_player, track)
+			if cached_destination is not None:
+				# The cached match is scored again, in case the destination track has changed since
+				score = pair.match(candidates=[cached_destination])
+				if pair.destination is not None:
+					return pair, score
+			return pair, pair.match(candidates=candidates.get(track.title))
+
+		if isinstance(self.destination_player, PlexPlayer):
+			# Matching only modifies the pair itself. Plex tracks can be searched from several threads, MediaMonkey's COM objects cannot
+			executor = ThreadPoolExecutor(max_workers=self.maximum_workers)
+			results = self.map_in_batches(executor, match, zip(tracks, cached_destinations), self.sync_chunk_size)
+		else:
+			executor = None
+			results = map(match, tracks, cached_destinations)
+
+		# Only the pairs that may be synchronized are kept, all others are done with once their match is cached.
+		# Pairs without conflicts are synchronized in chunks, while the remaining tracks are still being matched.
 		matched = 0
-		for pair in sync_pairs:
-			if pair.match():
+		synchronized = 0
+		pairs_need_update = []
+		pairs_conflicting = []
+		cache_entries = {}
+		for pair, score in results:
+			if score:
 				matched += 1
-		self.logger.info('Matched {}/{} tracks'.format(matched, len(sync_pairs)))
+			if pair.destination is not None:
+				self.matched_destinations[pair.source.ID] = pair.destination
+				if not pair.similar_match:
+					cache_entries[str(pair.source.ID)] = self.match_cache_entry(pair)
+			if pair.sync_state is SyncState.NEEDS_UPDATE:
+				pairs_need_update.append(pair)
+				if len(pairs_need_update) >= self.sync_chunk_size:
+					self.sync_pairs(pairs_need_update)
+					synchronized += len(pairs_need_update)
+					pairs_need_update = []
+			elif pair.sync_state is SyncState.CONFLICTING:
+				pairs_conflicting.append(pair)
+		if executor is not None:
+			executor.shutdown()
+		self.sync_pairs(pairs_need_update)
+		synchronized += len(pairs_need_update)
+		self.logger.info('Matched {}/{} tracks'.format(matched, len(tracks)))
+		self.logger.info('Synchronized {} matching tracks without conflicts'.format(synchronized))
+		self.write_match_cache(cache_entries)
 
-		if self.options.dry:
-			self.logger.info('Running a DRY RUN. No changes will be propagated!')
-		pairs_need_update = [pair for pair in sync_pairs if pair.sync_state is SyncState.NEEDS_UPDATE]
-		self.logger.info('Synchronizing {} matching tracks without conflicts'.format(len(pairs_need_update)))
-		for pair in pairs_need_update:
-			pair.sync()
-
-		pairs_conflicting = [pair for pair in sync_pairs if pair.sync_state is SyncState.CONFLICTING]
 		self.logger.info('{} pairs have conflicting ratings'.format(len(pairs_conflicting)))
 
+		if len(pairs_conflicting) == 0:
+			return
+		prompt = {
+			"1": "Keep all ratings from {} and update {}".format(self.source_player.name(), self.destination_player.name()),
+			"2": "Keep all ratings from {} and update {}".format(self.destination_player.name(), self.source_player.name()),
+			"3": "Choose rating for each track",
+			"4": "Display all conflicts",
+			"5": "Don\'t resolve conflicts"
+		}
+		# Each handler returns whether to prompt again
+		handlers = {
+			"1": self.keep_source_ratings,
+			"2": self.keep_destination_ratings,
+			"3": self.choose_ratings,
+			"4": self.display_conflicts,
+			"5": lambda pairs: False
+		}
 		choose = True
 		while choose:
-			choose = False
-			if len(pairs_conflicting) > 0:
-				prompt = {
-					"1": "Keep all ratings from {} and update {}".format(pair.source_player.name(), pair.destination_player.name()),
-					"2": "Keep all ratings from {} and update {}".format(pair.destination_player.name(), pair.source_player.name()),
-					"3": "Choose rating for each track",
-					"4": "Display all conflicts",
-					"5": "Don\'t resolve conflicts"
-				}
-				for key in prompt:
-					print('\t[{}]: {}'.format(key, prompt[key]))
-				choice = input('Select how to resolve conflicting rating: ')
-				if choice == '1':
-					for pair in pairs_conflicting:
-						# do what you were going to do anyway
-						pair.sync(force=True)
-				elif choice == '2':
-					for pair in pairs_conflicting:
-						# reverse source and destination assignment
-						(
-							pair.source, pair.source_player, pair.rating_source,
-							pair.destination, pair.destination_player, pair.rating_destination
-						) = (
-								pair.destination, pair.destination_player, pair.rating_destination,
-								pair.source, pair.source_player, pair.rating_source
-							)
-						pair.sync(force=True)
-				elif choice == '3':
-					for pair in pairs_conflicting:
-						result = pair.resolve_conflict()
-						if not result:
-							break
-				elif choice == '4':
-					for pair in pairs_conflicting:
-						print('Conflict: {} (Source - {}: {} | Destination - {}: {})'.format(
-							pair.source, pair.source_player.name(), pair.rating_source, pair.destination_player.name(), pair.rating_destination)
-						)
-					choose = True
-				elif choice != '5':
-					print('{} is not a valid choice, please try again.'.format(choice))
-					choose = True
+			self.flush_logs()
+			for key in prompt:
+				print('\t[{}]: {}'.format(key, prompt[key]))
+			choice = input('Select how to resolve conflicting rating: ')
+			handler = handlers.get(choice)
+			if handler is None:
+				print('{} is not a valid choice, please try again.'.format(choice))
+			else:
+				choose = handler(pairs_conflicting)
+
+	def keep_source_ratings(self, pairs):
+		# do what you were going to do anyway
+		self.sync_pairs(pairs, force=True)
+		return False
+
+	def keep_destination_ratings(self, pairs):
+		for pair in pairs:
+			pair.reverse_direction()
+		self.sync_pairs(pairs, force=True)
+		return False
+
+	@staticmethod
+	def choose_ratings(pairs):
+		for pair in pairs:
+			result = pair.resolve_conflict()
+			if not result:
+				break
+		return False
+
+	@staticmethod
+	def display_conflicts(pairs):
+		for pair in pairs:
+			print('Conflict: {} (Source - {}: {} | Destination - {}: {})'.format(
+				pair.source, pair.source_player.name(), pair.rating_source, pair.destination_player.name(), pair.rating_destination)
+			)
+		return True
+
+	@property
+	def plex_player(self) -> PlexPlayer:
+		return self.source_player if self.options.reverse else self.destination_player
+
+	@property
+	def match_cache_path(self):
+		return self.plex_player.cache_path(self.options.username, 'matches.json')
+
+	@property
+	def match_cache_section(self):
+		return '{} -> {}'.format(self.source_player.name(), self.destination_player.name())
+
+	@staticmethod
+	def match_cache_fields(track):
+		"""The fields of a source track that its cached match is valid for"""
+		return [track.title, track.artist, track.album, track.track]
+
+	def read_match_cache_file(self) -> dict:
+		try:
+			with open(self.match_cache_path) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {}
+
+	def read_match_cache(self, tracks):
+		"""
+		Looks up the destination tracks that the source @tracks were matched with by a previous run.
+		Matches of source tracks whose title, artist, album or track number have changed since are ignored.
+		:type tracks: list<AudioTag>
+		:return: the cached destination track of each source track, or None
+		"""
+		entries = self.read_match_cache_file().get(self.match_cache_section, {})
+		destination_ids = {}
+		for i, track in enumerate(tracks):
+			entry = entries.get(str(track.ID))
+			if entry is not None and entry['source'] == self.match_cache_fields(track):
+				destination_ids[i] = entry['destination']
+		found = self.destination_player.find_tracks(destination_ids.values()) if destination_ids else {}
+		return [found.get(destination_ids.get(i)) for i in range(len(tracks))]
+
+	def match_cache_entry(self, pair):
+		"""Describes the match of a pair with a destination track for the match cache"""
+		return {
+			'source': self.match_cache_fields(pair.source),
+			'destination': self.destination_player.track_id(pair.destination)
+		}
+
+	def write_match_cache(self, entries):
+		"""
+		Replaces the cached matches of this sync direction
+		:param entries: the match_cache_entry of each matched pair by the ID of its source track
+		"""
+		cache = self.read_match_cache_file()
+		cache[self.match_cache_section] = entries
+		self.plex_player.write_private_file(self.match_cache_path, json.dumps(cache))
+
+	@staticmethod
+	def map_in_batches(executor, function, arguments, batch_size):
+		"""
+		Like executor.map, but submits the calls in batches of @batch_size. The next batch is submitted before the results of
+		the current one are returned, so that the workers stay busy, but no more than two batches are held at once.
+		:param arguments: the tuple of arguments of each call of @function
+		"""
+		arguments = iter(arguments)
+		pending = [executor.submit(function, *call) for call in islice(arguments, batch_size)]
+		while pending:
+			following = [executor.submit(function, *call) for call in islice(arguments, batch_size)]
+			for future in pending:
+				yield future.result()
+			pending = following
+
+	@staticmethod
+	def sync_pairs(pairs, force=False):
+		"""
+		Propagates the source ratings of all pairs that need it, with one bulk update per destination player
+		:type pairs: list<TrackPair>
+		"""
+		updates = {}
+		for pair in pairs:
+			if pair.needs_sync(force):
+				updates.setdefault(pair.destination_player, []).append((pair.destination, pair.rating_source))
+		for player, player_updates in updates.items():
+			player.update_ratings_bulk(player_updates)
 
 	def sync_playlists(self):
 		if self.options.reverse:
 			raise NotImplementedError
-		playlists = self.local_player.read_playlists()
+		playlists = self.source_player.read_playlists()
 		playlist_pairs = [
-			PlaylistPair(self.local_player, self.remote_player, pl)
+			PlaylistPair(
+				self.source_player, self.destination_player, pl, matches=self.matched_destinations, maximum_workers=self.maximum_workers
+			)
 			for pl in playlists if not pl.is_auto_playlist]
 
 		if self.options.dry:
@@ -214,19 +390,30 @@ class PlexSync:
 			pair.sync()
 
 
+def positive_int(value):
+	number = int(value)
+	if number < 1:
+		raise argparse.ArgumentTypeError('{} is not a positive integer'.format(value))
+	return number
+
+
 def parse_args():
 	parser = configargparse.ArgumentParser(default_config_files=['./config.ini'], description='Synchronizes ID3 music ratings with a Plex media-server')
 	parser.add_argument('--dry', action='store_true', help='Does not apply any changes')
 	parser.add_argument('--reverse', action='store_true', help='Syncs ratings from Plex to local player')
-	parser.add_argument('--sync', nargs='*', default=['tracks'], help='Selects which items to sync: one or more of [tracks, playlists]')
+	parser.add_argument('--sync', nargs='*', type=str.lower, default=['tracks'], help='Selects which items to sync: one or more of [tracks, playlists]')
 	parser.add_argument('--log', default='info', help='Sets the logging level')
+	parser.add_argument('--max-workers', type=positive_int, help='The number of threads matching tracks with Plex (default: {})'.format(PlexSync.maximum_workers))
 	parser.add_argument('--passwd', type=str, help='The password for the plex user. NOT RECOMMENDED TO USE!')
 	parser.add_argument('--player', default='MediaMonkey', type=str, help='Media player to synchronize with Plex')
 	parser.add_argument('--server', type=str, required=True, help='The name of the plex media server')
 	parser.add_argument('--username', type=str, required=True, help='The plex username')
 	parser.add_argument('--token', type=str, help='Plex API token.  See https://support.plex.tv/articles/204059436-finding-an-authentication-token-x-plex-token/ for information on how to find your token')
 
-	return parser.parse_args()
+	args = parser.parse_args()
+	# Items given more than once are synchronized only once, in the order they were first given
+	args.sync = list(dict.fromkeys(args.sync))
+	return args
 
 
 if __name__ == "__main__":